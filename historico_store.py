@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import re
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from decouple import config
+
+# ========================================
+# CONFIGURAÇÕES
+# ========================================
+BASE_DIR = Path(__file__).resolve().parent
+HISTORICO_DB_PATH = Path(
+    config("HISTORICO_DB_PATH", default=str(BASE_DIR / "data" / "historico.sqlite3"))
+)
+HISTORICO_MESES = 13
+# Mínimo de meses registrados para pedir ao LLM apenas os meses novos.
+HISTORICO_MIN_MESES = config("HISTORICO_MIN_MESES", default=12, cast=int)
+
+MESES = ("JAN", "FEV", "MAR", "ABR", "MAI", "JUN", "JUL", "AGO", "SET", "OUT", "NOV", "DEZ")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS historico_consumo (
+    uc TEXT NOT NULL,
+    mes_chave TEXT NOT NULL,
+    consumo TEXT NOT NULL DEFAULT '',
+    atualizado_em TEXT NOT NULL,
+    PRIMARY KEY (uc, mes_chave)
+)
+"""
+
+
+# ========================================
+# NORMALIZAÇÃO
+# ========================================
+def normalizar_uc(valor: Optional[str]) -> Optional[str]:
+    """Normaliza o código UC para ``10/########-#``; ``None`` se não reconhecido."""
+    if not valor:
+        return None
+    match = re.search(r"(\d{2})\s*/\s*(\d{6,9})\s*-\s*(\d)", str(valor))
+    if not match:
+        return None
+    return f"{match.group(1)}/{match.group(2)}-{match.group(3)}"
+
+
+def detectar_uc(texto: str) -> Optional[str]:
+    """Procura no texto do PDF um código UC já no formato ``10/...-#``."""
+    match = re.search(r"\b10\s*/\s*\d{6,9}\s*-\s*\d\b", texto or "")
+    return normalizar_uc(match.group(0)) if match else None
+
+
+def chave_mes(rotulo: Optional[str]) -> Optional[str]:
+    """Converte rótulos como ``OUT/24``, ``Outubro de 2024`` ou ``10/2024`` em ``2024-10``.
+
+    Datas completas (``dd/mm/aaaa``) retornam ``None``.
+    """
+    if not rotulo:
+        return None
+    texto = str(rotulo).strip().upper()
+    mes: Optional[int] = None
+    ano: Optional[str] = None
+    match = re.search(r"([A-ZÇ]{3})[A-ZÇ]*\W*(?:DE\W*)?(\d{2,4})", texto)
+    if match and match.group(1) in MESES:
+        mes = MESES.index(match.group(1)) + 1
+        ano = match.group(2)
+    else:
+        # Apenas ``mm/aaaa``: datas completas (``01/10/2025``) não são meses.
+        match = re.search(
+            r"(?<![\d/.\-])(\d{1,2})(?:\s*[/.\-]\s*|\s+DE\s+)(\d{4})(?![/.\-]?\d)", texto
+        )
+        if match and 1 <= int(match.group(1)) <= 12:
+            mes = int(match.group(1))
+            ano = match.group(2)
+    if mes is None or ano is None or len(ano) == 3:
+        return None
+    if len(ano) == 2:
+        ano = f"20{ano}"
+    return f"{ano}-{mes:02d}"
+
+
+def rotulo_mes(chave: str) -> str:
+    """Rótulo de exibição (``OUT/2024``) a partir da chave ``2024-10``."""
+    ano, mes = chave.split("-")
+    return f"{MESES[int(mes) - 1]}/{ano}"
+
+
+# ========================================
+# ARMAZENAMENTO
+# ========================================
+def _connect() -> sqlite3.Connection:
+    HISTORICO_DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(HISTORICO_DB_PATH, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(SCHEMA)
+    return conn
+
+
+def ultimo_mes_registrado(uc: str) -> Optional[str]:
+    """Retorna a chave do mês mais recente conhecido, se a UC tiver histórico suficiente."""
+    with closing(_connect()) as conn:
+        total, ultimo = conn.execute(
+            "SELECT COUNT(*), MAX(mes_chave) FROM historico_consumo "
+            "WHERE uc = ? AND consumo != ''",
+            (uc,),
+        ).fetchone()
+    if total < HISTORICO_MIN_MESES:
+        return None
+    return ultimo
+
+
+def registrar_historico(uc: str, itens: Iterable[Dict]) -> None:
+    """Grava os meses extraídos; valores vazios não sobrescrevem dados conhecidos."""
+    agora = datetime.now().isoformat(timespec="seconds")
+    linhas = []
+    for item in itens:
+        chave = chave_mes(item.get("mes"))
+        if chave is None:
+            continue
+        linhas.append((uc, chave, str(item.get("consumo") or "").strip(), agora))
+    if not linhas:
+        return
+    with closing(_connect()) as conn, conn:
+        conn.executemany(
+            "INSERT INTO historico_consumo (uc, mes_chave, consumo, atualizado_em) "
+            "VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (uc, mes_chave) DO UPDATE SET "
+            "consumo = CASE WHEN excluded.consumo != '' "
+            "THEN excluded.consumo ELSE historico_consumo.consumo END, "
+            "atualizado_em = excluded.atualizado_em",
+            linhas,
+        )
+
+
+def historico_completo(
+    uc: str, ate: str, limite: int = HISTORICO_MESES
+) -> List[Dict[str, str]]:
+    """Últimos ``limite`` meses da UC até a chave ``ate`` (inclusive), em ordem cronológica."""
+    with closing(_connect()) as conn:
+        linhas = conn.execute(
+            "SELECT mes_chave, consumo FROM historico_consumo "
+            "WHERE uc = ? AND mes_chave <= ? ORDER BY mes_chave DESC LIMIT ?",
+            (uc, ate, limite),
+        ).fetchall()
+    return [
+        {"mes": rotulo_mes(chave), "consumo": consumo} for chave, consumo in reversed(linhas)
+    ]
@@ -0,0 +1,436 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from decouple import config
+
+# ========================================
+# CONFIGURAÇÕES
+# ========================================
+HEDGE_ENABLED = config("LLM_HEDGE_ENABLED", default=True, cast=bool)
+HEDGE_DEFAULT_SECONDS = config("LLM_HEDGE_DEFAULT_SECONDS", default=90.0, cast=float)
+HEDGE_MIN_SECONDS = config("LLM_HEDGE_MIN_SECONDS", default=10.0, cast=float)
+HEDGE_MAX_SECONDS = config("LLM_HEDGE_MAX_SECONDS", default=180.0, cast=float)
+HEDGE_MIN_SAMPLES = config("LLM_HEDGE_MIN_SAMPLES", default=8, cast=int)
+
+BREAKER_WINDOW = config("LLM_BREAKER_WINDOW", default=20, cast=int)
+BREAKER_MIN_CALLS = config("LLM_BREAKER_MIN_CALLS", default=5, cast=int)
+BREAKER_ERROR_RATE = config("LLM_BREAKER_ERROR_RATE", default=0.5, cast=float)
+BREAKER_COOLDOWN_SECONDS = config("LLM_BREAKER_COOLDOWN_SECONDS", default=30.0, cast=float)
+# Intervalo de nova consulta enquanto a chamada de teste (semiaberto) não termina.
+BREAKER_TRIAL_POLL_SECONDS = 1.0
+
+LLM_MODEL = config("LLM_MODEL", default="gpt-5")
+RATE_LIMIT_RPM = config("LLM_RATE_LIMIT_RPM", default=500, cast=int)
+RATE_LIMIT_TPM = config("LLM_RATE_LIMIT_TPM", default=450_000, cast=int)
+OUTPUT_TOKENS_ESTIMATE = config("LLM_OUTPUT_TOKENS_ESTIMATE", default=2_000, cast=int)
+
+
+class CircuitOpenError(RuntimeError):
+    """Indica que o circuito do LLM está aberto e a chamada foi recusada."""
+
+    def __init__(self, retry_after: float) -> None:
+        self.retry_after = retry_after
+        super().__init__(
+            "Serviço de IA instável no momento; nova tentativa em "
+            f"{retry_after:.0f}s."
+        )
+
+
+# ========================================
+# LATÊNCIA ADAPTATIVA
+# ========================================
+class LatencyTracker:
+    """Mantém as latências recentes e calcula o prazo (p95) para o hedge."""
+
+    def __init__(self, window: int = 100) -> None:
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(pct * (len(samples) - 1))))
+        return samples[index]
+
+    def hedge_deadline(self) -> float:
+        """Prazo a partir do qual uma requisição duplicada é disparada."""
+        with self._lock:
+            count = len(self._samples)
+        if count < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_SECONDS
+        p95 = self.percentile(0.95) or HEDGE_DEFAULT_SECONDS
+        return max(HEDGE_MIN_SECONDS, min(HEDGE_MAX_SECONDS, p95))
+
+
+# ========================================
+# CIRCUIT BREAKER
+# ========================================
+class CircuitBreaker:
+    """Abre o circuito quando a taxa de erro recente ultrapassa o limite."""
+
+    CLOSED = "fechado"
+    OPEN = "aberto"
+    HALF_OPEN = "semiaberto"
+
+    def __init__(
+        self,
+        window: int = BREAKER_WINDOW,
+        min_calls: int = BREAKER_MIN_CALLS,
+        error_rate: float = BREAKER_ERROR_RATE,
+        cooldown: float = BREAKER_COOLDOWN_SECONDS,
+    ) -> None:
+        self._outcomes: Deque[bool] = deque(maxlen=window)
+        self._min_calls = min_calls
+        self._error_rate = error_rate
+        self._cooldown = cooldown
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state_locked()
+
+    def _state_locked(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at >= self._cooldown:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def _retry_after_locked(self) -> float:
+        state = self._state_locked()
+        if state == self.OPEN:
+            return max(0.0, self._cooldown - (time.monotonic() - self._opened_at))
+        if state == self.HALF_OPEN and self._trial_in_flight:
+            return BREAKER_TRIAL_POLL_SECONDS
+        return 0.0
+
+    def retry_after(self) -> float:
+        """Segundos até valer a pena tentar de novo; 0 se uma chamada seria aceita.
+
+        No estado semiaberto com a chamada de teste em andamento, retorna o
+        intervalo de nova consulta, pois o fim do teste não é previsível.
+        """
+        with self._lock:
+            return self._retry_after_locked()
+
+    def before_call(self) -> bool:
+        """Falha imediatamente se o circuito estiver aberto.
+
+        Retorna ``True`` quando a chamada autorizada é a chamada de teste do
+        estado semiaberto; quem a recebe deve registrar o resultado ou chamar
+        ``release_trial``.
+        """
+        with self._lock:
+            state = self._state_locked()
+            if state == self.CLOSED:
+                return False
+            if state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            remaining = self._retry_after_locked()
+        raise CircuitOpenError(remaining)
+
+    def release_trial(self) -> None:
+        """Libera a vaga de teste de uma chamada abortada sem resultado."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._outcomes.append(True)
+            if self._opened_at is not None:
+                self._opened_at = None
+                self._trial_in_flight = False
+                self._outcomes.clear()
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._outcomes.append(False)
+            if self._opened_at is not None:
+                # Falha na chamada de teste: reabre por mais um período.
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+                return
+            if len(self._outcomes) < self._min_calls:
+                return
+            failures = self._outcomes.count(False)
+            if failures / len(self._outcomes) >= self._error_rate:
+                self._opened_at = time.monotonic()
+
+
+# ========================================
+# MÉTRICAS
+# ========================================
+class HedgeMetrics:
+    """Contadores de chamadas, hedges disparados e hedges vencedores."""
+
+    def __init__(self) -> None:
+        self._counters: Dict[str, int] = {
+            "requisicoes": 0,
+            "hedges_disparados": 0,
+            "hedges_vencedores": 0,
+            "falhas": 0,
+            "recusadas_circuito": 0,
+        }
+        self._lock = threading.Lock()
+
+    def incr(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters)
+
+
+# ========================================
+# LIMITE DE TAXA (PROCESSO INTEIRO)
+# ========================================
+class TokenBucket:
+    """Balde de fichas reabastecido continuamente a ``per_minute`` por minuto."""
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = float(per_minute)
+        self._rate = float(per_minute) / 60.0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def time_until(self, amount: float) -> float:
+        self._refill()
+        missing = min(amount, self.capacity) - self._tokens
+        return max(0.0, missing / self._rate)
+
+    def cost_seconds(self, amount: float) -> float:
+        return min(amount, self.capacity) / self._rate
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self._tokens -= min(amount, self.capacity)
+
+
+class _Ticket:
+    __slots__ = ("session_id", "tokens")
+
+    def __init__(self, session_id: str, tokens: int) -> None:
+        self.session_id = session_id
+        self.tokens = tokens
+
+
+class RateLimiter:
+    """Agenda chamadas ao LLM respeitando os limites de requisições e tokens.
+
+    As filas são mantidas por sessão e atendidas em rodízio, de modo que um lote
+    grande de um operador não bloqueia os demais.
+    """
+
+    def __init__(self, rpm: int = RATE_LIMIT_RPM, tpm: int = RATE_LIMIT_TPM) -> None:
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._queues: "OrderedDict[str, Deque[_Ticket]]" = OrderedDict()
+        self._cond = threading.Condition()
+
+    def _order_locked(self) -> List[_Ticket]:
+        """Ordem de atendimento: rodízio entre sessões, FIFO dentro de cada uma."""
+        queues = [list(queue) for queue in self._queues.values()]
+        order: List[_Ticket] = []
+        depth = max((len(queue) for queue in queues), default=0)
+        for rank in range(depth):
+            order.extend(queue[rank] for queue in queues if rank < len(queue))
+        return order
+
+    def _ticket_seconds(self, ticket: _Ticket) -> float:
+        return max(
+            self._requests.cost_seconds(1), self._tokens.cost_seconds(ticket.tokens)
+        )
+
+    def _remove_locked(self, ticket: _Ticket) -> None:
+        queue = self._queues.get(ticket.session_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(ticket)
+        except ValueError:
+            return
+        if queue:
+            # A sessão atendida vai para o fim do rodízio.
+            self._queues.move_to_end(ticket.session_id)
+        else:
+            del self._queues[ticket.session_id]
+
+    def acquire(
+        self,
+        session_id: str,
+        tokens: int,
+        on_wait: Optional[Callable[[int, float], None]] = None,
+    ) -> None:
+        """Bloqueia até haver orçamento para a chamada desta sessão.
+
+        ``on_wait(posicao, eta_segundos)`` é chamado enquanto a chamada aguarda
+        na fila; a posição 1 indica que ela é a próxima a ser atendida.
+        """
+        ticket = _Ticket(session_id, tokens)
+        served = False
+        with self._cond:
+            self._queues.setdefault(session_id, deque()).append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    order = self._order_locked()
+                    position = order.index(ticket)
+                    head_wait = max(
+                        self._requests.time_until(1),
+                        self._tokens.time_until(order[0].tokens),
+                    )
+                    if position == 0 and head_wait <= 0:
+                        self._requests.take(1)
+                        self._tokens.take(tokens)
+                        self._remove_locked(ticket)
+                        served = True
+                        self._cond.notify_all()
+                        return
+                    eta = head_wait + sum(
+                        self._ticket_seconds(ahead) for ahead in order[1 : position + 1]
+                    )
+                if on_wait is not None:
+                    on_wait(position + 1, eta)
+                with self._cond:
+                    self._cond.wait(timeout=min(1.0, max(0.05, head_wait)))
+        finally:
+            if not served:
+                with self._cond:
+                    self._remove_locked(ticket)
+                    self._cond.notify_all()
+
+    def try_acquire(self, tokens: int) -> bool:
+        """Consome orçamento sem esperar, apenas se ninguém estiver na fila."""
+        with self._cond:
+            if self._queues:
+                return False
+            if self._requests.time_until(1) > 0 or self._tokens.time_until(tokens) > 0:
+                return False
+            self._requests.take(1)
+            self._tokens.take(tokens)
+            return True
+
+
+_encoding = None
+
+
+def estimar_tokens(texto: str) -> int:
+    """Estima os tokens do prompt com ``tiktoken`` (ou ~4 caracteres por token)."""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+
+            try:
+                _encoding = tiktoken.encoding_for_model(LLM_MODEL)
+            except KeyError:
+                _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:  # noqa: BLE001
+            _encoding = False
+    if _encoding is False:
+        return max(1, len(texto) // 4)
+    return len(_encoding.encode(texto, disallowed_special=()))
+
+
+# ========================================
+# CHAMADA COM HEDGE
+# ========================================
+latency_tracker = LatencyTracker()
+llm_breaker = CircuitBreaker()
+hedge_metrics = HedgeMetrics()
+rate_limiter = RateLimiter()
+
+_executor = ThreadPoolExecutor(
+    max_workers=config("LLM_HEDGE_WORKERS", default=16, cast=int),
+    thread_name_prefix="llm-hedge",
+)
+
+
+def invoke_with_hedge(
+    call: Callable[[], Any],
+    acquire: Optional[Callable[[], None]] = None,
+    can_hedge: Optional[Callable[[], bool]] = None,
+) -> Any:
+    """Executa ``call`` com circuit breaker e hedge após o prazo adaptativo (p95).
+
+    Se a primeira requisição não terminar dentro do prazo, uma duplicada é
+    disparada e vence a que responder primeiro com sucesso. ``acquire`` é
+    chamado antes do circuit breaker (por exemplo, para aguardar o limite de
+    taxa, que pode ser interrompido por um rerun do Streamlit); ``can_hedge``
+    permite vetar a duplicata quando não há orçamento disponível.
+    """
+    if acquire is not None:
+        acquire()
+    try:
+        is_trial = llm_breaker.before_call()
+    except CircuitOpenError:
+        hedge_metrics.incr("recusadas_circuito")
+        raise
+    try:
+        return _race(call, can_hedge)
+    except BaseException:
+        # Sucesso e falha já liberam a vaga de teste; isto cobre interrupções.
+        if is_trial:
+            llm_breaker.release_trial()
+        raise
+
+
+def _race(call: Callable[[], Any], can_hedge: Optional[Callable[[], bool]]) -> Any:
+    """Dispara a requisição e, após o prazo, a duplicata; retorna a primeira resposta."""
+    hedge_metrics.incr("requisicoes")
+    started = time.monotonic()
+    primary: Future = _executor.submit(call)
+    pending = {primary}
+    hedge: Optional[Future] = None
+
+    if HEDGE_ENABLED:
+        done, _ = wait(pending, timeout=latency_tracker.hedge_deadline())
+        if not done and (can_hedge is None or can_hedge()):
+            hedge = _executor.submit(call)
+            pending.add(hedge)
+            hedge_metrics.incr("hedges_disparados")
+
+    last_error: Optional[BaseException] = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            error = future.exception()
+            if error is not None:
+                last_error = error
+                continue
+            # Latência ponta a ponta desde a requisição original: registrar só o
+            # tempo do hedge vencedor subestimaria a cauda e reduziria o prazo.
+            latency_tracker.record(time.monotonic() - started)
+            result = future.result()
+            llm_breaker.record_success()
+            if future is hedge:
+                hedge_metrics.incr("hedges_vencedores")
+            for loser in pending:
+                loser.cancel()
+            return result
+
+    hedge_metrics.incr("falhas")
+    llm_breaker.record_failure()
+    assert last_error is not None
+    raise last_error
@@ -0,0 +1,525 @@
+"""Teste de carga de um servidor Streamlit real com sessões simultâneas.
+
+Sobe ``streamlit run app.py`` em um processo (com o LLM substituído por um stub
+de latência configurável) e conecta N clientes headless pelo mesmo websocket
+usado pelo navegador (``/_stcore/stream``). Cada cliente faz login, envia os
+PDFs pelo endpoint de upload do ``st.file_uploader``, processa o lote, prepara
+o .zip e o baixa pela URL do ``st.download_button``. Assim as sessões disputam
+o mesmo processo: limite de taxa, executor de hedge, cache de PDFs e GIL.
+
+Para cada número de sessões simultâneas o relatório mostra percentis de
+latência por etapa e, amostrados do PID do servidor via ``/proc`` (Linux), o
+RSS (base, pico e acréscimo por sessão) e o tempo de CPU por sessão.
+
+Limitações: os clientes não executam o frontend (JS, CSS, componentes), então
+o custo medido é apenas o do servidor.
+
+Uso:
+    python loadtest.py --sessions 1,2,4,8 --pdf-dir pdfs --files 5 --llm-latency 2
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import uuid
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+import streamlit.web.cli as stcli
+from streamlit.proto.Alert_pb2 import Alert
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.Common_pb2 import FileUploaderState
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.WidgetStates_pb2 import WidgetState
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.websocket import websocket_connect
+
+BASE_DIR = Path(__file__).resolve().parent
+
+STUB_FATURA = {
+    "nome do cliente": "CLIENTE TESTE DE CARGA",
+    "data de emissao": "01/10/2025",
+    "data de vencimento": "15/10/2025",
+    "codigo do cliente - uc": "10/12345678-9",
+    "mes de referencia": "SET/2025",
+    "consumo kwh": "350",
+    "valor a pagar": "245,00",
+    "Economia": "105,00",
+    "historico de consumo": [
+        {"mes": f"{mes}/2025", "consumo": str(300 + index * 10)}
+        for index, mes in enumerate(
+            ("JAN", "FEV", "MAR", "ABR", "MAI", "JUN", "JUL", "AGO", "SET")
+        )
+    ],
+    "saldo acumulado": "0,00",
+    "preco unit com tributos": "1,099590",
+    "Energia Atv Injetada": "318,29",
+}
+
+
+class StubLLM:
+    """Substitui o ``ChatOpenAI`` com resposta fixa após ``latency`` segundos."""
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+
+    def invoke(self, prompt: str) -> SimpleNamespace:
+        time.sleep(self.latency)
+        return SimpleNamespace(content=json.dumps(STUB_FATURA, ensure_ascii=False))
+
+
+# ========================================
+# SERVIDOR
+# ========================================
+def servir(port: int, llm_latency: float) -> None:
+    """Executa ``streamlit run app.py`` neste processo com o LLM simulado."""
+    import main  # só o servidor carrega o app; os clientes não precisam dele.
+
+    main.llm = StubLLM(llm_latency)
+    sys.argv = [
+        "streamlit", "run", str(BASE_DIR / "app.py"),
+        "--server.port", str(port),
+        "--server.address", "127.0.0.1",
+        "--server.headless", "true",
+        "--server.fileWatcherType", "none",
+        "--browser.gatherUsageStats", "false",
+    ]
+    sys.exit(stcli.main())
+
+
+def porta_livre() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def iniciar_servidor(
+    port: int, llm_latency: float, env: Dict[str, str], log_path: Path, timeout: float
+) -> subprocess.Popen:
+    with open(log_path, "wb") as log:
+        processo = subprocess.Popen(
+            [sys.executable, __file__, "--servir", "--port", str(port),
+             "--llm-latency", str(llm_latency)],
+            cwd=BASE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT,
+        )
+    prazo = time.monotonic() + timeout
+    while time.monotonic() < prazo:
+        if processo.poll() is not None:
+            break
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1):
+                return processo
+        except OSError:
+            time.sleep(0.2)
+    processo.kill()
+    raise SystemExit(
+        f"Servidor Streamlit não respondeu; log:\n{log_path.read_text(errors='replace')[-4000:]}"
+    )
+
+
+# ========================================
+# CLIENTE HEADLESS
+# ========================================
+class SessaoWS:
+    """Cliente do protocolo websocket do Streamlit (o que o navegador faria)."""
+
+    def __init__(self, base_url: str, timeout: float) -> None:
+        self.base_url = base_url
+        self.timeout = timeout
+        self.http = AsyncHTTPClient(force_instance=True)
+        self.cookie = ""
+        self.xsrf = ""
+        self.ws = None
+        self.session_id = ""
+        self.page_hash = ""
+        self.widgets: Dict[str, object] = {}
+        self.elementos: Dict[Tuple[int, ...], Tuple[object, str]] = {}
+
+    async def conectar(self) -> None:
+        # O health check define o cookie XSRF exigido pelo endpoint de upload.
+        resposta = await self.http.fetch(f"{self.base_url}/_stcore/health")
+        for cabecalho in resposta.headers.get_list("Set-Cookie"):
+            nome, _, resto = cabecalho.partition("=")
+            if nome.strip() == "_streamlit_xsrf":
+                self.xsrf = resto.split(";", 1)[0]
+                self.cookie = f"_streamlit_xsrf={self.xsrf}"
+        url = self.base_url.replace("http", "ws", 1) + "/_stcore/stream"
+        self.ws = await websocket_connect(
+            HTTPRequest(url, headers={"Cookie": self.cookie} if self.cookie else {}),
+            max_message_size=256 * 1024 * 1024,
+        )
+        await self.rerun()
+
+    async def fechar(self) -> None:
+        if self.ws is not None:
+            self.ws.close()
+        self.http.close()
+
+    async def _enviar(self, mensagem: BackMsg) -> None:
+        await self.ws.write_message(mensagem.SerializeToString(), binary=True)
+
+    async def _receber(self) -> ForwardMsg:
+        dados = await asyncio.wait_for(self.ws.read_message(), self.timeout)
+        if dados is None:
+            raise ConnectionError("websocket encerrado pelo servidor")
+        mensagem = ForwardMsg()
+        mensagem.ParseFromString(dados)
+        return mensagem
+
+    async def rerun(self, gatilhos: Tuple[str, ...] = (), fragment_id: str = "") -> None:
+        """Envia o estado dos widgets (como o navegador) e aguarda o fim da execução."""
+        mensagem = BackMsg()
+        estado = mensagem.rerun_script
+        estado.page_script_hash = self.page_hash
+        estado.fragment_id = fragment_id
+        for widget in self.widgets.values():
+            estado.widget_states.widgets.append(widget)
+        for widget_id in gatilhos:
+            gatilho = estado.widget_states.widgets.add()
+            gatilho.id = widget_id
+            gatilho.trigger_value = True
+        await self._enviar(mensagem)
+        await self._aguardar_execucao(parcial=bool(fragment_id))
+
+    async def _aguardar_execucao(self, parcial: bool) -> None:
+        elementos: Dict[Tuple[int, ...], Tuple[object, str]] = {}
+        while True:
+            mensagem = await self._receber()
+            tipo = mensagem.WhichOneof("type")
+            if tipo == "new_session":
+                sessao = mensagem.new_session
+                self.session_id = sessao.initialize.session_id or self.session_id
+                self.page_hash = sessao.page_script_hash
+                elementos = {}
+            elif tipo == "delta" and mensagem.delta.WhichOneof("type") == "new_element":
+                elemento = mensagem.delta.new_element
+                if elemento.WhichOneof("type") == "exception":
+                    raise RuntimeError(elemento.exception.message)
+                if (
+                    elemento.WhichOneof("type") == "alert"
+                    and elemento.alert.format == Alert.ERROR
+                ):
+                    raise RuntimeError(elemento.alert.body)
+                elementos[tuple(mensagem.metadata.delta_path)] = (
+                    elemento,
+                    mensagem.delta.fragment_id,
+                )
+            elif tipo == "script_finished":
+                status = mensagem.script_finished
+                if status == ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    continue
+                if status == ForwardMsg.FINISHED_WITH_COMPILE_ERROR:
+                    raise RuntimeError("erro de compilação no script")
+                if parcial:
+                    self.elementos.update(elementos)
+                else:
+                    self.elementos = elementos
+                return
+
+    def widget(self, tipo: str, rotulo: str) -> Tuple[object, str]:
+        """Widget atual do ``tipo`` cujo rótulo começa com ``rotulo`` e seu fragmento."""
+        for elemento, fragment_id in self.elementos.values():
+            if elemento.WhichOneof("type") != tipo:
+                continue
+            proto = getattr(elemento, tipo)
+            if proto.label.startswith(rotulo):
+                return proto, fragment_id
+        raise LookupError(f"{tipo} '{rotulo}' não encontrado na página")
+
+    def definir_texto(self, rotulo: str, valor: str) -> None:
+        proto, _ = self.widget("text_input", rotulo)
+        self.widgets[proto.id] = WidgetState(id=proto.id, string_value=valor)
+
+    async def clicar(self, tipo: str, rotulo: str) -> None:
+        proto, fragment_id = self.widget(tipo, rotulo)
+        if proto.disabled:
+            raise RuntimeError(f"botão '{rotulo}' desabilitado")
+        await self.rerun((proto.id,), fragment_id)
+
+    async def enviar_arquivos(self, rotulo: str, caminhos: List[str]) -> None:
+        """Faz o upload como o ``st.file_uploader``: pede URLs, envia via PUT e reexecuta."""
+        uploader, _ = self.widget("file_uploader", rotulo)
+        pedido = BackMsg()
+        pedido.file_urls_request.request_id = uuid.uuid4().hex
+        pedido.file_urls_request.session_id = self.session_id
+        pedido.file_urls_request.file_names.extend(Path(c).name for c in caminhos)
+        await self._enviar(pedido)
+        while True:
+            mensagem = await self._receber()
+            if (
+                mensagem.WhichOneof("type") == "file_urls_response"
+                and mensagem.file_urls_response.response_id
+                == pedido.file_urls_request.request_id
+            ):
+                break
+        resposta = mensagem.file_urls_response
+        if resposta.error_msg:
+            raise RuntimeError(resposta.error_msg)
+
+        estado = FileUploaderState()
+        for indice, (caminho, urls) in enumerate(zip(caminhos, resposta.file_urls)):
+            conteudo = Path(caminho).read_bytes()
+            await self._put_arquivo(urls.upload_url, Path(caminho).name, conteudo)
+            info = estado.uploaded_file_info.add()
+            info.id = indice + 1
+            info.name = Path(caminho).name
+            info.size = len(conteudo)
+            info.file_id = urls.file_id
+            info.file_urls.CopyFrom(urls)
+        estado.max_file_id = len(caminhos)
+        self.widgets[uploader.id] = WidgetState(
+            id=uploader.id, file_uploader_state_value=estado
+        )
+        await self.rerun()
+
+    async def _put_arquivo(self, url: str, nome: str, conteudo: bytes) -> None:
+        fronteira = uuid.uuid4().hex
+        corpo = (
+            f"--{fronteira}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{nome}"\r\n'
+            "Content-Type: application/pdf\r\n\r\n"
+        ).encode() + conteudo + f"\r\n--{fronteira}--\r\n".encode()
+        headers = {"Content-Type": f"multipart/form-data; boundary={fronteira}"}
+        if self.xsrf:
+            headers.update({"Cookie": self.cookie, "X-Xsrftoken": self.xsrf})
+        await self.http.fetch(
+            self.base_url + url, method="PUT", body=corpo, headers=headers,
+            request_timeout=self.timeout,
+        )
+
+    async def baixar(self, rotulo: str) -> int:
+        """Baixa o arquivo do ``st.download_button`` em blocos e registra o clique."""
+        proto, fragment_id = self.widget("download_button", rotulo)
+        recebido = 0
+
+        def contar(bloco: bytes) -> None:
+            nonlocal recebido
+            recebido += len(bloco)
+
+        await self.http.fetch(
+            self.base_url + proto.url, streaming_callback=contar,
+            headers={"Cookie": self.cookie} if self.cookie else None,
+            request_timeout=self.timeout,
+        )
+        if not proto.ignore_rerun:
+            await self.rerun((proto.id,), fragment_id)
+        return recebido
+
+
+# ========================================
+# ETAPAS DE UMA SESSÃO
+# ========================================
+async def run_session(
+    base_url: str, pdf_paths: List[str], credenciais: Tuple[str, str], timeout: float
+) -> Dict[str, Optional[float]]:
+    tempos: Dict[str, Optional[float]] = {
+        "login": None, "upload": None, "processar": None, "zip": None
+    }
+    sessao = SessaoWS(base_url, timeout)
+    try:
+        started = time.perf_counter()
+        await sessao.conectar()
+        sessao.definir_texto("Usuário", credenciais[0])
+        sessao.definir_texto("Senha", credenciais[1])
+        await sessao.clicar("button", "Entrar")
+        tempos["login"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        await sessao.enviar_arquivos("Selecionar faturas", pdf_paths)
+        tempos["upload"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        await sessao.clicar("button", "Processar arquivos")
+        tempos["processar"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        await sessao.clicar("button", "Preparar .zip")
+        if not await sessao.baixar("Download de todos"):
+            raise RuntimeError(".zip vazio")
+        tempos["zip"] = time.perf_counter() - started
+
+        await sessao.clicar("button", "Sair")
+    finally:
+        await sessao.fechar()
+    return tempos
+
+
+# ========================================
+# MÉTRICAS
+# ========================================
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status", encoding="utf-8") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def cpu_s(pid: int) -> float:
+    with open(f"/proc/{pid}/stat", encoding="utf-8") as stat:
+        campos = stat.read().rsplit(")", 1)[1].split()
+    # utime e stime são os campos 14 e 15 de /proc/<pid>/stat.
+    return (int(campos[11]) + int(campos[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def run_round(
+    sessions: int,
+    base_url: str,
+    pid: int,
+    pdf_paths: List[str],
+    credenciais: Tuple[str, str],
+    timeout: float,
+) -> Dict:
+    rss_base = rss_mb(pid)
+    cpu_start = cpu_s(pid)
+    pico = rss_base
+    ativo = True
+
+    async def amostrar() -> None:
+        nonlocal pico
+        while ativo:
+            pico = max(pico, rss_mb(pid))
+            await asyncio.sleep(0.1)
+
+    amostrador = asyncio.create_task(amostrar())
+    wall_start = time.perf_counter()
+    saidas = await asyncio.gather(
+        *(run_session(base_url, pdf_paths, credenciais, timeout) for _ in range(sessions)),
+        return_exceptions=True,
+    )
+    duracao = time.perf_counter() - wall_start
+    ativo = False
+    await amostrador
+    cpu_total = cpu_s(pid) - cpu_start
+
+    amostras = [saida for saida in saidas if not isinstance(saida, BaseException)]
+    erros = [
+        f"{type(saida).__name__}: {saida}" for saida in saidas if isinstance(saida, BaseException)
+    ]
+    etapas = {}
+    for etapa in ("login", "upload", "processar", "zip"):
+        valores = [item[etapa] for item in amostras]
+        if valores:
+            etapas[etapa] = {
+                "p50": percentile(valores, 0.50),
+                "p95": percentile(valores, 0.95),
+                "p99": percentile(valores, 0.99),
+                "max": max(valores),
+            }
+    return {
+        "sessoes": sessions,
+        "duracao_s": duracao,
+        "etapas": etapas,
+        "rss_base_mb": rss_base,
+        "rss_pico_mb": pico,
+        "rss_por_sessao_mb": (pico - rss_base) / sessions,
+        "cpu_total_s": cpu_total,
+        "cpu_por_sessao_s": cpu_total / sessions,
+        "erros": erros,
+    }
+
+
+def print_report(rodada: Dict) -> None:
+    print(
+        f"\n=== {rodada['sessoes']} sessões | {rodada['duracao_s']:.1f}s | "
+        f"RSS servidor {rodada['rss_base_mb']:.0f}→{rodada['rss_pico_mb']:.0f} MB "
+        f"(+{rodada['rss_por_sessao_mb']:.1f} MB/sessão) | "
+        f"CPU/sessão {rodada['cpu_por_sessao_s']:.2f}s ==="
+    )
+    for etapa, valores in rodada["etapas"].items():
+        print(
+            f"  {etapa:<9} p50 {valores['p50']:.2f}s  p95 {valores['p95']:.2f}s  "
+            f"p99 {valores['p99']:.2f}s  max {valores['max']:.2f}s"
+        )
+    if rodada["erros"]:
+        print(f"  erros: {len(rodada['erros'])} (ex.: {rodada['erros'][0]})")
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", default="1,2,4,8", help="Sessões simultâneas por rodada.")
+    parser.add_argument("--pdf-dir", default=str(BASE_DIR / "pdfs"), help="Pasta com PDFs de exemplo.")
+    parser.add_argument("--files", type=int, default=5, help="Arquivos por lote em cada sessão.")
+    parser.add_argument("--llm-latency", type=float, default=2.0, help="Latência do LLM simulado (s).")
+    parser.add_argument("--timeout", type=float, default=600.0, help="Timeout de cada etapa (s).")
+    parser.add_argument("--port", type=int, default=0, help="Porta do servidor (padrão: livre).")
+    parser.add_argument("--json", dest="json_path", help="Grava o relatório completo neste arquivo.")
+    parser.add_argument("--servir", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.servir:
+        servir(args.port, args.llm_latency)
+        return
+
+    pdfs = sorted(Path(args.pdf_dir).glob("*.pdf"))
+    if not pdfs:
+        raise SystemExit(f"Nenhum PDF encontrado em {args.pdf_dir}.")
+    lote = [str(pdfs[index % len(pdfs)]) for index in range(args.files)]
+
+    # Variáveis exigidas pelo app; os limites de taxa ficam altos para medir o
+    # app e não o agendador (podem ser sobrescritos pelo ambiente).
+    workdir = Path(tempfile.mkdtemp(prefix="loadtest_"))
+    env = dict(os.environ)
+    env.setdefault("OPENAI_API_KEY", "loadtest")
+    env.setdefault("APP_USERNAME", "loadtest")
+    env.setdefault("APP_PASSWORD", "loadtest")
+    env.setdefault("LLM_RATE_LIMIT_RPM", "1000000")
+    env.setdefault("LLM_RATE_LIMIT_TPM", "1000000000")
+    env.setdefault("HISTORICO_DB_PATH", str(workdir / "historico.sqlite3"))
+    env.setdefault("SPOOL_DIR", str(workdir / "spool"))
+    credenciais = (env["APP_USERNAME"], env["APP_PASSWORD"])
+
+    port = args.port or porta_livre()
+    servidor = None
+    try:
+        servidor = iniciar_servidor(
+            port, args.llm_latency, env, workdir / "streamlit.log", args.timeout
+        )
+        # Sessão de aquecimento fora do relatório: a primeira execução paga os
+        # imports do app e inflaria o RSS e a CPU da primeira rodada.
+        asyncio.run(
+            run_session(f"http://127.0.0.1:{port}", lote[:1], credenciais, args.timeout)
+        )
+        relatorio = []
+        for sessions in (int(valor) for valor in args.sessions.split(",")):
+            rodada = asyncio.run(
+                run_round(
+                    sessions, f"http://127.0.0.1:{port}", servidor.pid, lote,
+                    credenciais, args.timeout,
+                )
+            )
+            print_report(rodada)
+            relatorio.append(rodada)
+    finally:
+        if servidor is not None:
+            servidor.terminate()
+            try:
+                servidor.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                servidor.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json_path:
+        Path(args.json_path).write_text(
+            json.dumps(relatorio, indent=2, ensure_ascii=False), encoding="utf-8"
+        )
+
+
+if __name__ == "__main__":
+    main_cli()
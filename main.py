@@ -2,21 +2,42 @@ from __future__ import annotations
 
 import json
 from pathlib import Path
-from typing import IO, List, Union
+from typing import IO, Callable, List, Optional, Union
 
 import pdfplumber
 from decouple import config
+from pypdf import PdfReader
+from pypdf.errors import PyPdfError
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import PromptTemplate
 from pydantic import BaseModel, ConfigDict, Field, ValidationError
 
+import historico_store
+from llm_guard import (
+    LLM_MODEL,
+    OUTPUT_TOKENS_ESTIMATE,
+    estimar_tokens,
+    invoke_with_hedge,
+    rate_limiter,
+)
+from spool import abrir_mmap
+
 # ========================================
 # CONFIGURAÇÕES
 # ========================================
 OPENAI_API_KEY = config("OPENAI_API_KEY")
 
+# Limites da triagem prévia (preflight)
+PREFLIGHT_MAX_MB = config("PREFLIGHT_MAX_MB", default=15.0, cast=float)
+PREFLIGHT_MAX_PAGINAS = config("PREFLIGHT_MAX_PAGINAS", default=12, cast=int)
+# Páginas lidas na triagem antes de concluir que o PDF não tem camada de texto.
+PREFLIGHT_PAGINAS_TEXTO = 2
+# Pistas que identificam uma fatura de energia na primeira página com texto.
+FATURA_PISTAS = ("KWH", "FATURA", "CONSUMO", "VENCIMENTO", "ENERGIA", "TARIFA")
+FATURA_MIN_PISTAS = 2
+
 # Inicializa modelo LLM
-llm = ChatOpenAI(model="gpt-5", api_key=OPENAI_API_KEY, temperature=0)
+llm = ChatOpenAI(model=LLM_MODEL, api_key=OPENAI_API_KEY, temperature=0)
 
 
 # ========================================
@@ -73,10 +94,16 @@ Orientações específicas:
 - "nome do cliente": geralmente aparece após "PAGADOR" ou destacado próximo ao endereço do cliente.
 - "codigo do cliente - uc": normalize para o formato "10/########-#". Prefira valores já com "10/" na fatura (ex.: "10/33525227-0"). Se só houver versões fragmentadas (ex.: "3352527-2025-9-6"), reconstrua removendo sufixos extras e aplicando o prefixo "10/" com o dígito verificador mais plausível.
 - "consumo kwh" está no campo Quant. ao lado de Unit. kWh. Ele será encontrado em itens da fatura
+{% if historico_desde %}
+- "historico de consumo": o histórico anterior desta UC já está registrado até {{ historico_desde }}.
+  Retorne somente os meses POSTERIORES a {{ historico_desde }} (normalmente apenas o mês de referência),
+  lidos da seção CONSUMO DOS ÚLTIMOS 13 meses ou da lista "Consumo FATURADO".
+{% else %}
 - "historico de consumo": extraia pares de mês e consumo da seção CONSUMO DOS ÚLTIMOS 13 meses ou da lista "Consumo FATURADO".
   Quando números e meses estiverem em colunas diferentes, faça a correspondência
   usando proximidade e ordem: valores mais recentes devem ser ligados aos meses mais recentes
   e meses sem valor claramente identificado devem receber "".
+{% endif %}
 - "preco unit com tributos": busque o valor decimal da coluna "Preço unit (R$) com tributos" como valor aproximado de 1,099590.
 - "Energia Atv Injetada": identifique todas as linhas de energia ativa injetada (Energia Atv Injetada), ela está em itens da fatura, e some as quantidades e divida pelo preco unit com tributos. Remova sinais negativos, normalize para o formato brasileiro e desconsidere valores que não estejam explicitamente ligados à energia injetada.
 - "valor a pagar": calcule como `valor_a_pagar = energia_injetada_total_kwh * preco_unit_com_tributos * 0.7`. Se qualquer um desses valores estiver ausente.
@@ -111,8 +138,88 @@ Texto a ser analisado:
 # ========================================
 # FUNÇÕES PRINCIPAIS
 # ========================================
+def triar_pdf(caminho_pdf: Union[str, Path, IO[bytes]]) -> dict:
+    """Triagem rápida com pypdf antes da extração completa e do LLM.
+
+    Verifica tamanho, criptografia, número de páginas, presença de camada de
+    texto (nas ``PREFLIGHT_PAGINAS_TEXTO`` primeiras páginas) e se a primeira
+    página com texto parece uma fatura de energia. O ``status`` é "aceito",
+    "revisar" (não parece fatura) ou "rejeitado".
+    """
+    triagem = {
+        "status": "aceito",
+        "motivo": "",
+        "paginas": 0,
+        "tamanho_kb": 0,
+        "criptografado": False,
+        "camada_texto": False,
+        "fatura": False,
+    }
+
+    if hasattr(caminho_pdf, "seek"):
+        caminho_pdf.seek(0, 2)
+        tamanho = caminho_pdf.tell()
+        caminho_pdf.seek(0)
+    else:
+        tamanho = Path(caminho_pdf).stat().st_size
+    triagem["tamanho_kb"] = round(tamanho / 1024)
+
+    def rejeitar(motivo: str) -> dict:
+        triagem.update(status="rejeitado", motivo=motivo)
+        return triagem
+
+    if tamanho > PREFLIGHT_MAX_MB * 1024 * 1024:
+        return rejeitar(f"Arquivo maior que {PREFLIGHT_MAX_MB:g} MB.")
+    if tamanho == 0:
+        return rejeitar("Arquivo vazio.")
+    if not hasattr(caminho_pdf, "seek"):
+        # Arquivos em disco são lidos via memory map, sem cópia integral em memória.
+        with abrir_mmap(Path(caminho_pdf)) as mapa:
+            return triar_pdf(mapa)
+
+    try:
+        reader = PdfReader(caminho_pdf)
+        if reader.is_encrypted:
+            triagem["criptografado"] = True
+            if not reader.decrypt(""):
+                return rejeitar("PDF protegido por senha.")
+        paginas = reader.pages
+        triagem["paginas"] = len(paginas)
+        if not paginas:
+            return rejeitar("PDF sem páginas.")
+        if len(paginas) > PREFLIGHT_MAX_PAGINAS:
+            return rejeitar(f"PDF com mais de {PREFLIGHT_MAX_PAGINAS} páginas.")
+
+        # Fontes podem estar só em Form XObjects, fora do /Resources da página;
+        # extrair o texto de uma ou duas páginas é barato e não depende disso.
+        texto = ""
+        for pagina in paginas[:PREFLIGHT_PAGINAS_TEXTO]:
+            texto = pagina.extract_text() or ""
+            if texto.strip():
+                break
+    except (PyPdfError, ValueError, KeyError) as exc:
+        return rejeitar(f"PDF ilegível: {exc}")
+    finally:
+        if hasattr(caminho_pdf, "seek"):
+            caminho_pdf.seek(0)
+
+    triagem["camada_texto"] = bool(texto.strip())
+    if not triagem["camada_texto"]:
+        return rejeitar("PDF sem camada de texto (provavelmente digitalizado).")
+
+    texto_upper = texto.upper()
+    pistas = sum(1 for pista in FATURA_PISTAS if pista in texto_upper)
+    triagem["fatura"] = pistas >= FATURA_MIN_PISTAS
+    if not triagem["fatura"]:
+        triagem.update(status="revisar", motivo="Não parece uma fatura de energia.")
+    return triagem
+
+
 def ler_pdf(caminho_pdf: Union[str, Path, IO[bytes]]) -> str:
-    """Extrai texto de um PDF usando pdfplumber, preservando melhor a estrutura."""
+    """Extrai texto de um PDF usando pdfplumber, preservando melhor a estrutura.
+
+    Prefira passar o caminho do arquivo: o pdfplumber lê do disco sob demanda.
+    """
     if hasattr(caminho_pdf, "seek"):
         caminho_pdf.seek(0)
 
@@ -125,10 +232,55 @@ def ler_pdf(caminho_pdf: Union[str, Path, IO[bytes]]) -> str:
     return "\n\n".join(partes)
 
 
-def extrair_dados(texto_pdf: str) -> dict:
-    """Envia o texto do PDF ao LLM e retorna o JSON estruturado validado."""
-    prompt = PROMPT_TEMPLATE.format(text_pdf=texto_pdf)
-    resposta = llm.invoke(prompt)
+def extrair_dados(
+    texto_pdf: str,
+    sessao: str = "local",
+    ao_aguardar: Optional[Callable[[int, float], None]] = None,
+) -> dict:
+    """Envia o texto do PDF ao LLM e retorna o JSON estruturado validado.
+
+    A chamada aguarda o limite de taxa compartilhado entre as sessões
+    (``sessao`` identifica a fila; ``ao_aguardar`` recebe posição e ETA), passa
+    pelo circuit breaker e recebe uma requisição duplicada (hedge) se
+    ultrapassar o prazo adaptativo; ver ``llm_guard``.
+
+    Para UCs com histórico registrado, o LLM extrai apenas os meses novos e o
+    "historico de consumo" retornado é montado a partir de ``historico_store``.
+    Se a UC devolvida pelo LLM divergir da UC lida no texto, a extração é
+    refeita com o histórico completo.
+    """
+    uc_detectada = historico_store.detectar_uc(texto_pdf)
+    historico_desde = (
+        historico_store.ultimo_mes_registrado(uc_detectada) if uc_detectada else None
+    )
+    dados = _invocar_llm(texto_pdf, historico_desde, sessao, ao_aguardar)
+    if historico_desde:
+        uc_llm = historico_store.normalizar_uc(dados.get("codigo do cliente - uc"))
+        if uc_llm != uc_detectada:
+            # O prompt curto foi escolhido pela UC lida no texto; se o LLM
+            # reconstruiu outra UC, o histórico parcial não pertence a ela.
+            dados = _invocar_llm(texto_pdf, None, sessao, ao_aguardar)
+    return consolidar_historico(dados)
+
+
+def _invocar_llm(
+    texto_pdf: str,
+    historico_desde: Optional[str],
+    sessao: str,
+    ao_aguardar: Optional[Callable[[int, float], None]],
+) -> dict:
+    prompt = PROMPT_TEMPLATE.format(
+        text_pdf=texto_pdf,
+        historico_desde=historico_store.rotulo_mes(historico_desde)
+        if historico_desde
+        else "",
+    )
+    tokens = estimar_tokens(prompt) + OUTPUT_TOKENS_ESTIMATE
+    resposta = invoke_with_hedge(
+        lambda: llm.invoke(prompt),
+        acquire=lambda: rate_limiter.acquire(sessao, tokens, on_wait=ao_aguardar),
+        can_hedge=lambda: rate_limiter.try_acquire(tokens),
+    )
 
     try:
         dados_raw = json.loads(resposta.content)
@@ -145,8 +297,27 @@ def extrair_dados(texto_pdf: str) -> dict:
     return resultado.model_dump(by_alias=True)
 
 
+def consolidar_historico(dados: dict) -> dict:
+    """Registra o histórico extraído e o substitui pelo histórico completo da UC."""
+    uc = historico_store.normalizar_uc(dados.get("codigo do cliente - uc"))
+    if uc is None:
+        return dados
+    historico_store.registrar_historico(uc, dados.get("historico de consumo", []))
+    referencia = historico_store.chave_mes(dados.get("mes de referencia"))
+    if referencia is None:
+        # Sem mês de referência não há como limitar o histórico a esta fatura.
+        return dados
+    historico = historico_store.historico_completo(uc, ate=referencia)
+    if len(historico) >= len(dados.get("historico de consumo", [])):
+        dados["historico de consumo"] = historico
+    return dados
+
+
 def processar_pdf(caminho_pdf: Union[str, Path, IO[bytes]]) -> dict:
     """Extrai texto do PDF e retorna o dicionário estruturado com os dados da fatura."""
+    triagem = triar_pdf(caminho_pdf)
+    if triagem["status"] == "rejeitado":
+        raise ValueError(triagem["motivo"])
     texto = ler_pdf(caminho_pdf)
     if not texto.strip():
         raise ValueError("Nenhum texto foi extraído do PDF.")
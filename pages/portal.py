@@ -1,32 +1,28 @@
 from __future__ import annotations
 
-from datetime import datetime
-from io import BytesIO
+import time
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional, Sequence
 from zipfile import ZIP_DEFLATED, ZipFile
 
-import re
-
 import streamlit as st
-from jinja2 import Environment, FileSystemLoader, select_autoescape
-from weasyprint import HTML
-
-from asset_utils import get_logo_data_uri, get_logo_path, get_qrcode_data_uri
-from main import extrair_dados, ler_pdf
+import streamlit.components.v1 as components
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from asset_utils import get_logo_path
+from llm_guard import CircuitOpenError, hedge_metrics, llm_breaker
+from main import extrair_dados, ler_pdf, triar_pdf
+from pdf_render import render_pdf, render_pdfs_em_lote, render_preview_html
+from spool import Spool, limpar_spools_antigos
 from ui_theme import inject_global_styles
 
 # ========================================
 # CONFIGURAÇÕES
 # ========================================
-BASE_DIR = Path(__file__).resolve().parent.parent
-TEMPLATES_DIR = BASE_DIR / "templates"
-
-env = Environment(
-    loader=FileSystemLoader(TEMPLATES_DIR),
-    autoescape=select_autoescape(["html"]),
-)
-PDF_TEMPLATE = env.get_template("fatura_pdf.html")
+PDF_BULK_CHUNK = 20
+RESULTS_PER_PAGE = 10
+# Tentativas por arquivo enquanto o circuito do LLM recusa chamadas.
+CIRCUIT_RETRIES = 3
 
 inject_global_styles()
 
@@ -37,177 +33,318 @@ inject_global_styles()
 def ensure_dashboard_state() -> None:
     if "results" not in st.session_state:
         st.session_state.results: List[dict] = []
+    if "results_zip" not in st.session_state:
+        st.session_state.results_zip = None
+    if "results_page" not in st.session_state:
+        st.session_state.results_page = 1
+    if "triagens" not in st.session_state:
+        st.session_state.triagens: Dict[str, dict] = {}
+
+
+def get_spool() -> Spool:
+    """Diretório temporário da sessão para uploads e PDFs gerados."""
+    if "spool" not in st.session_state:
+        limpar_spools_antigos()
+        st.session_state.spool = Spool(current_session_id())
+    st.session_state.spool.tocar()
+    return st.session_state.spool
+
+
+def pdf_destino(resultado: dict) -> Path:
+    return get_spool().caminho_pdf(f'{resultado["indice"]:04d}_{resultado["filename"]}')
+
+
+def pdf_disponivel(resultado: dict) -> bool:
+    """Indica se o PDF já está no spool; caminhos apagados voltam a ``None``.
+
+    O spool pode ser removido por ``limpar_spools_antigos`` de outra sessão.
+    """
+    caminho = resultado.get("pdf_path")
+    if caminho is not None and not Path(caminho).exists():
+        resultado["pdf_path"] = None
+    return resultado.get("pdf_path") is not None
+
+
+def ensure_pdf(resultado: dict) -> Path:
+    """Gera o PDF do resultado apenas quando solicitado e o grava no spool."""
+    if not pdf_disponivel(resultado):
+        destino = pdf_destino(resultado)
+        destino.write_bytes(render_pdf(resultado["dados"]))
+        resultado["pdf_path"] = str(destino)
+    return Path(resultado["pdf_path"])
+
+
+def gerar_pdfs_pendentes(
+    results: List[dict], ao_progredir: Optional[Callable[[int, int], None]] = None
+) -> None:
+    """Gera em blocos os PDFs que ainda não existem, gravando cada um em disco."""
+    pendentes = [item for item in results if not pdf_disponivel(item)]
+    for inicio in range(0, len(pendentes), PDF_BULK_CHUNK):
+        lote = pendentes[inicio : inicio + PDF_BULK_CHUNK]
+        pdfs = render_pdfs_em_lote([item["dados"] for item in lote])
+        for resultado, pdf_bytes in zip(lote, pdfs):
+            destino = pdf_destino(resultado)
+            destino.write_bytes(pdf_bytes)
+            resultado["pdf_path"] = str(destino)
+        if ao_progredir is not None:
+            ao_progredir(inicio + len(lote), len(pendentes))
+
+
+def aguardar_circuito() -> None:
+    """Pausa o lote enquanto o circuito do LLM recusar chamadas.
+
+    Cobre o circuito aberto e também o semiaberto com a chamada de teste de
+    outra sessão ainda em andamento.
+    """
+    espera = llm_breaker.retry_after()
+    if espera <= 0:
+        return
+    aviso = st.empty()
+    while espera > 0:
+        if llm_breaker.state == llm_breaker.OPEN:
+            mensagem = f"Lote pausado; retomando em {espera:.0f}s."
+        else:
+            mensagem = "Lote pausado; aguardando a chamada de teste ao serviço."
+        aviso.warning(
+            f"Muitas falhas recentes no serviço de IA. {mensagem}",
+            icon="⏸️",
+        )
+        time.sleep(min(1.0, espera))
+        espera = llm_breaker.retry_after()
+    aviso.empty()
+
 
+def current_session_id() -> str:
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else "local"
 
-def map_pdf_context(dados: Dict) -> Dict:
-    def pick(key: str, default: str = "—") -> str:
-        raw = dados.get(key, "")
-        if raw is None:
-            return default
-        text = str(raw).strip()
-        return text if text else default
-
-    def parse_decimal(value: Optional[object]) -> Optional[float]:
-        if value is None:
-            return None
-        if isinstance(value, (int, float)):
-            return float(value)
-        text = str(value).strip()
-        if not text:
-            return None
-        # remove currency and thousand separators
-        text = re.sub(r"[^\d,.-]", "", text)
-        if not text:
-            return None
-        text = text.replace(".", "").replace(",", ".")
-        try:
-            return float(text)
-        except ValueError:
-            return None
-
-    def format_currency(value: Optional[float]) -> str:
-        if value is None:
-            return ""
-        formatted = f"{value:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-        return f"R$ {formatted}"
-
-    def format_number(value: Optional[float], suffix: str = "") -> str:
-        if value is None:
-            return ""
-        formatted = (
-            f"{value:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+
+def build_queue_notifier(placeholder) -> Callable[[int, float], None]:
+    """Mostra ao operador sua posição na fila compartilhada do LLM."""
+
+    def notify(posicao: int, eta: float) -> None:
+        placeholder.info(
+            f"Aguardando limite da IA: posição {posicao} na fila, "
+            f"previsão de ~{eta:.0f}s.",
+            icon="⏳",
         )
-        return f"{formatted}{suffix}"
-
-    def split_mes_ano(label: str) -> (str, str):
-        if not label:
-            return ("—", "")
-        label = label.strip()
-        match = re.match(r"([A-Za-zÀ-ÿ]+)[^\d]*(\d{2,4})", label)
-        if match:
-            mes = match.group(1).upper()
-            ano = match.group(2)
-            if len(ano) == 2:
-                ano = f"20{ano}"
-            return (mes, ano)
-        return (label, "")
-
-    consumo_atual_val = parse_decimal(pick("consumo kwh", ""))
-    energia_injetada_val = parse_decimal(pick("Energia Atv Injetada", ""))
-    preco_unitario_val = parse_decimal(pick("preco unit com tributos", ""))
-    valor_total_val = parse_decimal(pick("valor a pagar", ""))
-    economia_val = parse_decimal(pick("Economia", ""))
-    valor_pagar_val = parse_decimal(pick("valor a pagar", ""))
-    saldo_acumulado_val = parse_decimal(pick("saldo acumulado", ""))
-
-    historico_items = []
-    consumos_validos: List[float] = []
-    for raw_item in dados.get("historico de consumo", []):
-        if isinstance(raw_item, dict):
-            mes_label = raw_item.get("mes", "")
-            consumo_raw = raw_item.get("consumo", "")
-        else:
-            mes_label = getattr(raw_item, "mes", "")
-            consumo_raw = getattr(raw_item, "consumo", "")
-        mes, ano = split_mes_ano(mes_label)
-        consumo_val = parse_decimal(consumo_raw)
-        has_consumo = consumo_val is not None and consumo_val > 0
-        if has_consumo:
-            consumos_validos.append(consumo_val)
-        historico_items.append(
+
+    return notify
+
+
+def render_llm_metrics() -> None:
+    metricas = hedge_metrics.snapshot()
+    st.sidebar.caption(
+        f"IA: {metricas['requisicoes']} chamadas · "
+        f"{metricas['hedges_disparados']} hedges "
+        f"({metricas['hedges_vencedores']} vencedores) · "
+        f"circuito {llm_breaker.state}"
+    )
+
+
+def build_zip(results: List[dict], destino: Path) -> Path:
+    """Monta o .zip em disco a partir dos PDFs do spool, regerando os que sumiram."""
+    with ZipFile(destino, "w", compression=ZIP_DEFLATED) as zip_file:
+        for item in results:
+            zip_file.write(ensure_pdf(item), arcname=f"{item['filename']}.pdf")
+    return destino
+
+
+def triar_uploads(arquivos: Sequence) -> List[dict]:
+    """Executa a triagem prévia de cada arquivo do spool, uma única vez por arquivo."""
+    cache = st.session_state.triagens
+    triagens = []
+    for item in arquivos:
+        chave = str(item)
+        if chave not in cache:
+            cache[chave] = triar_pdf(item)
+        triagens.append(cache[chave])
+    return triagens
+
+
+def render_triage_summary(arquivos: Sequence, triagens: List[dict]) -> None:
+    contagem = {status: 0 for status in ("aceito", "revisar", "rejeitado")}
+    for triagem in triagens:
+        contagem[triagem["status"]] += 1
+    st.caption(
+        f"Triagem: {contagem['aceito']} aceitos · {contagem['revisar']} para revisar · "
+        f"{contagem['rejeitado']} rejeitados"
+    )
+    if contagem["revisar"] or contagem["rejeitado"]:
+        linhas = [
             {
-                "rotulo": f"{mes}/{ano}" if ano else mes,
-                "consumo_display": format_number(consumo_val, " kWh")
-                if consumo_val is not None
-                else ("Sem dados" if consumo_raw in (None, "", "0") else consumo_raw),
-                "has_consumo": has_consumo,
+                "Arquivo": item.name,
+                "Status": triagem["status"],
+                "Motivo": triagem["motivo"],
+                "Páginas": triagem["paginas"],
+                "Tamanho (KB)": triagem["tamanho_kb"],
             }
-        )
+            for item, triagem in zip(arquivos, triagens)
+        ]
+        st.dataframe(linhas, use_container_width=True, hide_index=True)
+
+
+def processar_arquivos(arquivos: Sequence, pdf_sob_demanda: bool = True) -> List[dict]:
+    """Extrai os dados de cada PDF do lote; erros individuais são exibidos na página.
+
+    ``arquivos`` são caminhos no spool (ou arquivos abertos); os PDFs gerados no
+    modo imediato são gravados em disco.
+    """
+    resultados = []
+    sessao = current_session_id()
+    fila = st.empty()
+    notificar_fila = build_queue_notifier(fila)
+    for item in arquivos:
+        aguardar_circuito()
+        with st.spinner(f"Processando {item.name}..."):
+            try:
+                if hasattr(item, "seek"):
+                    item.seek(0)
+                texto = ler_pdf(item)
+                for tentativa in range(1, CIRCUIT_RETRIES + 1):
+                    try:
+                        dados = extrair_dados(texto, sessao, notificar_fila)
+                        break
+                    except CircuitOpenError:
+                        if tentativa == CIRCUIT_RETRIES:
+                            raise
+                        aguardar_circuito()
+                fila.empty()
+                resultado = {
+                    "indice": len(resultados),
+                    "filename": Path(item.name).stem,
+                    "dados": dados,
+                    "pdf_path": None,
+                }
+                if not pdf_sob_demanda:
+                    ensure_pdf(resultado)
+                resultados.append(resultado)
+            except Exception as exc:  # noqa: BLE001
+                st.error(f"Erro ao processar {item.name}: {exc}")
+    return resultados
 
-    historico_resumo = ""
-    if consumos_validos:
-        media = sum(consumos_validos) / len(consumos_validos)
-        historico_resumo = (
-            f"{len(consumos_validos)} meses com consumo registrado | "
-            f"Média: {format_number(media, ' kWh')}"
-        )
 
-    bandeira_val = dados.get("bandeira") or ""
-    bandeira_classe = ""
-    if isinstance(bandeira_val, str):
-        lower = bandeira_val.lower()
-        if "vermelha" in lower:
-            bandeira_classe = "bandeira-vermelha"
-        elif "amarela" in lower:
-            bandeira_classe = "bandeira-amarela"
-        elif lower.strip():
-            bandeira_classe = "bandeira-verde"
-
-    cliente = {
-        "nome": pick("nome do cliente"),
-        "codigo_uc": pick("codigo do cliente - uc"),
-        "cpf_cnpj": dados.get("documento do cliente", "—"),
-        "telefone": dados.get("telefone", ""),
-        "email": dados.get("email", ""),
-        "endereco": dados.get("endereco", None),
-    }
-
-    fatura = {
-        "numero_fatura": dados.get("numero da fatura", pick("codigo do cliente - uc")),
-        "data_vencimento": pick("data de vencimento"),
-        "data_emissao": pick("data de emissao"),
-        "valor_total_display": format_currency(valor_total_val) or pick("valor a pagar"),
-        "valor_total_num": valor_total_val or 0.0,
-        "codigo_barras": dados.get("codigo de barras", ""),
-        "saldo_acumulado_display": format_currency(saldo_acumulado_val)
-        if saldo_acumulado_val is not None
-        else pick("saldo acumulado"),
-    }
-
-    context = {
-        "logo_path": get_logo_data_uri(),
-        "qrcode_path": get_qrcode_data_uri(),
-        "mes_referencia": pick("mes de referencia"),
-        "data_atual": datetime.now().strftime("%d/%m/%Y"),
-        "cliente": cliente,
-        "fatura": fatura,
-        "consumo_atual": format_number(consumo_atual_val, " kWh")
-        if consumo_atual_val is not None
-        else pick("consumo kwh"),
-        "energia_ativa_display": format_number(energia_injetada_val, " kWh")
-        if energia_injetada_val is not None
-        else pick("Energia Atv Injetada"),
-        "preco_unitario_display": format_number(preco_unitario_val)
-        if preco_unitario_val is not None
-        else pick("preco unit com tributos"),
-        "economia_display": format_currency(economia_val)
-        if economia_val is not None
-        else "",
-        "valor_pagar_display": format_currency(valor_pagar_val)
-        if valor_pagar_val is not None
-        else fatura["valor_total_display"],
-        "saldo_acumulado_display": fatura["saldo_acumulado_display"],
-        "bandeira": bandeira_val if isinstance(bandeira_val, str) else "",
-        "bandeira_classe": bandeira_classe,
-        "historico_consumo": historico_items,
-        "historico_resumo": historico_resumo,
-    }
-    return context
-
-def render_pdf(dados: Dict) -> bytes:
-    context = map_pdf_context(dados)
-    html_content = PDF_TEMPLATE.render(**context)
-    pdf_bytes = HTML(string=html_content, base_url=str(TEMPLATES_DIR)).write_pdf()
-    return pdf_bytes
-
-
-def build_zip(results: List[dict]) -> bytes:
-    buffer = BytesIO()
-    with ZipFile(buffer, "w", compression=ZIP_DEFLATED) as zip_file:
-        for item in results:
-            zip_file.writestr(f"{item['filename']}.pdf", item["pdf"])
-    buffer.seek(0)
-    return buffer.getvalue()
+# ========================================
+# RESULTADOS
+# ========================================
+def render_results_summary(results: List[dict]) -> None:
+    linhas = [
+        {
+            "Arquivo": item["filename"],
+            "Cliente": item["dados"].get("nome do cliente", ""),
+            "UC": item["dados"].get("codigo do cliente - uc", ""),
+            "Referência": item["dados"].get("mes de referencia", ""),
+            "Consumo (kWh)": item["dados"].get("consumo kwh", ""),
+            "Valor a pagar": item["dados"].get("valor a pagar", ""),
+        }
+        for item in results
+    ]
+    st.dataframe(linhas, use_container_width=True, hide_index=True)
+
+
+@st.fragment
+def render_result_card(index: int) -> None:
+    """Cartão de um resultado; interações aqui reexecutam só este fragmento."""
+    resultado = st.session_state.results[index]
+    st.markdown(
+        f'<div class="result-card"><h3>{resultado["filename"]}</h3></div>',
+        unsafe_allow_html=True,
+    )
+    col_json, col_preview = st.columns(2)
+    with col_json:
+        mostrar_json = st.toggle("Ver JSON", key=f"result_json_{index}")
+    with col_preview:
+        mostrar_preview = st.toggle("Pré-visualizar", key=f"result_preview_{index}")
+    if mostrar_json:
+        st.json(resultado["dados"], expanded=False)
+    if mostrar_preview:
+        components.html(
+            render_preview_html(resultado["dados"]), height=900, scrolling=True
+        )
+    if not pdf_disponivel(resultado):
+        if st.button("Gerar PDF", key=f"result_render_{index}"):
+            with st.spinner(f"Gerando PDF de {resultado['filename']}..."):
+                ensure_pdf(resultado)
+    if resultado.get("pdf_path") is not None:
+        with open(resultado["pdf_path"], "rb") as arquivo_pdf:
+            st.download_button(
+                label="Download em PDF",
+                data=arquivo_pdf,
+                file_name=f'{resultado["filename"]}.pdf',
+                mime="application/pdf",
+                key=f"result_pdf_{index}",
+            )
+    st.divider()
+
+
+@st.fragment
+def render_results_page() -> None:
+    """Mostra apenas a página corrente dos resultados."""
+    total = len(st.session_state.results)
+    paginas = max(1, -(-total // RESULTS_PER_PAGE))
+    if st.session_state.results_page > paginas:
+        st.session_state.results_page = paginas
+    if paginas > 1:
+        st.number_input(
+            f"Página (1–{paginas})",
+            min_value=1,
+            max_value=paginas,
+            step=1,
+            key="results_page",
+        )
+    inicio = (st.session_state.results_page - 1) * RESULTS_PER_PAGE
+    fim = min(inicio + RESULTS_PER_PAGE, total)
+    st.caption(f"Exibindo {inicio + 1}–{fim} de {total} faturas.")
+    for index in range(inicio, fim):
+        with st.container():
+            render_result_card(index)
+
+
+def descartar_zip() -> None:
+    """Apaga o .zip já entregue e retira o botão de download da tela."""
+    if st.session_state.results_zip:
+        Path(st.session_state.results_zip).unlink(missing_ok=True)
+    st.session_state.results_zip = None
+
+
+@st.fragment
+def render_zip_download() -> None:
+    """Monta o .zip só quando solicitado e o descarta depois do download.
+
+    O ``st.download_button`` guarda os dados em memória enquanto está na tela,
+    então o .zip não fica disponível permanentemente.
+    """
+    if st.session_state.results_zip and not Path(st.session_state.results_zip).exists():
+        st.session_state.results_zip = None
+    if st.session_state.results_zip is None:
+        pendentes = sum(
+            1 for item in st.session_state.results if not pdf_disponivel(item)
+        )
+        rotulo = "Preparar .zip"
+        if pendentes:
+            rotulo += f" ({pendentes} PDFs a gerar)"
+        if not st.button(rotulo, key="results_zip_prepare"):
+            return
+        if pendentes:
+            progresso = st.progress(0.0, text="Gerando PDFs pendentes...")
+            gerar_pdfs_pendentes(
+                st.session_state.results,
+                lambda feitos, total: progresso.progress(
+                    feitos / total, text=f"{feitos} de {total} PDFs gerados"
+                ),
+            )
+            progresso.empty()
+        st.session_state.results_zip = str(
+            build_zip(st.session_state.results, get_spool().caminho_zip())
+        )
+    with open(st.session_state.results_zip, "rb") as arquivo_zip:
+        st.download_button(
+            label="Download de todos (.zip)",
+            data=arquivo_zip,
+            file_name="faturas_boeira.zip",
+            mime="application/zip",
+            on_click=descartar_zip,
+        )
 
 
 # ========================================
@@ -220,6 +357,9 @@ def main() -> None:
         st.warning("Faça login para acessar o portal.")
         st.switch_page("app.py")
         st.stop()
+    if "spool" in st.session_state:
+        # Mantém o spool ativo mesmo sem uploads na tela (ver limpar_spools_antigos).
+        get_spool()
 
     logo_path = get_logo_path()
     if logo_path.exists():
@@ -232,8 +372,13 @@ def main() -> None:
     if st.sidebar.button("Sair", use_container_width=True):
         st.session_state.authenticated = False
         st.session_state.results = []
+        st.session_state.results_zip = None
+        if "spool" in st.session_state:
+            st.session_state.spool.remover()
+            del st.session_state.spool
         st.switch_page("app.py")
         st.stop()
+    render_llm_metrics()
 
     st.title("Central de Processamento Boeira 🌩️")
     st.caption("Envie uma ou mais faturas em PDF para extrair os dados estruturados.")
@@ -245,58 +390,59 @@ def main() -> None:
         help="Você pode arrastar vários arquivos PDF ao mesmo tempo.",
     )
 
+    pdf_sob_demanda = st.toggle(
+        "Gerar PDFs sob demanda",
+        value=True,
+        key="pdf_sob_demanda",
+        help=(
+            "Mostra uma pré-visualização HTML imediata e só gera o PDF quando "
+            "o arquivo (ou o .zip) for solicitado."
+        ),
+    )
+
+    selecionados = []
+    if uploaded_files:
+        spool = get_spool()
+        caminhos = [
+            spool.salvar_upload(item, getattr(item, "file_id", None) or item.name)
+            for item in uploaded_files
+        ]
+        triagens = triar_uploads(caminhos)
+        render_triage_summary(caminhos, triagens)
+        incluir_revisar = any(t["status"] == "revisar" for t in triagens) and st.checkbox(
+            "Processar também os arquivos marcados para revisão",
+            key="incluir_revisar",
+        )
+        selecionados = [
+            item
+            for item, triagem in zip(caminhos, triagens)
+            if triagem["status"] == "aceito"
+            or (triagem["status"] == "revisar" and incluir_revisar)
+        ]
+
     processar = st.button(
         "Processar arquivos",
         type="primary",
-        disabled=not uploaded_files,
+        disabled=not selecionados,
         help="Envia os PDFs selecionados para leitura e análise.",
     )
 
-    if processar and uploaded_files:
-        resultados = []
-        for item in uploaded_files:
-            with st.spinner(f"Processando {item.name}..."):
-                try:
-                    item.seek(0)
-                    texto = ler_pdf(item)
-                    dados = extrair_dados(texto)
-                    pdf_bytes = render_pdf(dados)
-                    resultados.append(
-                        {
-                            "filename": Path(item.name).stem,
-                            "dados": dados,
-                            "pdf": pdf_bytes,
-                        }
-                    )
-                except Exception as exc:  # noqa: BLE001
-                    st.error(f"Erro ao processar {item.name}: {exc}")
+    if processar and selecionados:
+        get_spool().limpar_saidas()
+        for anterior in st.session_state.results:
+            anterior["pdf_path"] = None
+        st.session_state.results_zip = None
+        resultados = processar_arquivos(selecionados, pdf_sob_demanda)
         if resultados:
             st.session_state.results = resultados
+            st.session_state.results_zip = None
+            st.session_state.results_page = 1
 
     if st.session_state.results:
         st.subheader("Resultados")
-        for resultado in st.session_state.results:
-            with st.container():
-                st.markdown(
-                    f'<div class="result-card"><h3>{resultado["filename"]}</h3></div>',
-                    unsafe_allow_html=True,
-                )
-                st.json(resultado["dados"])
-                st.download_button(
-                    label="Download em PDF",
-                    data=resultado["pdf"],
-                    file_name=f'{resultado["filename"]}.pdf',
-                    mime="application/pdf",
-                )
-                st.divider()
-
-        zip_bytes = build_zip(st.session_state.results)
-        st.download_button(
-            label="Download de todos (.zip)",
-            data=zip_bytes,
-            file_name="faturas_boeira.zip",
-            mime="application/zip",
-        )
+        render_results_summary(st.session_state.results)
+        render_results_page()
+        render_zip_download()
 
 
 if __name__ == "__main__":
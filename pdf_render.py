@@ -0,0 +1,305 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from weasyprint import CSS, HTML
+from weasyprint.text.fonts import FontConfiguration
+
+from asset_utils import get_logo_data_uri, get_qrcode_data_uri
+
+# ========================================
+# CONFIGURAÇÕES
+# ========================================
+# Módulo importável (e não a página do Streamlit, reexecutada a cada rerun) para
+# que a folha de estilo compilada e o cache de PDFs durem o processo inteiro.
+BASE_DIR = Path(__file__).resolve().parent
+TEMPLATES_DIR = BASE_DIR / "templates"
+
+env = Environment(
+    loader=FileSystemLoader(TEMPLATES_DIR),
+    autoescape=select_autoescape(["html"]),
+)
+PDF_TEMPLATE = env.get_template("fatura_pdf.html")
+PREVIEW_TEMPLATE = env.get_template("fatura.html")
+
+# Folha de estilo estática do PDF, compilada uma única vez por processo.
+FONT_CONFIG = FontConfiguration()
+PDF_STYLESHEET = CSS(
+    filename=str(TEMPLATES_DIR / "fatura_pdf.css"), font_config=FONT_CONFIG
+)
+
+PDF_CACHE_SIZE = 32
+_pdf_cache: "OrderedDict[str, bytes]" = OrderedDict()
+_pdf_cache_lock = threading.Lock()
+
+
+# ========================================
+# CONTEXTO E RENDERIZAÇÃO
+# ========================================
+def map_pdf_context(dados: Dict, data_atual: Optional[date] = None) -> Dict:
+    def pick(key: str, default: str = "—") -> str:
+        raw = dados.get(key, "")
+        if raw is None:
+            return default
+        text = str(raw).strip()
+        return text if text else default
+
+    def parse_decimal(value: Optional[object]) -> Optional[float]:
+        if value is None:
+            return None
+        if isinstance(value, (int, float)):
+            return float(value)
+        text = str(value).strip()
+        if not text:
+            return None
+        # remove currency and thousand separators
+        text = re.sub(r"[^\d,.-]", "", text)
+        if not text:
+            return None
+        text = text.replace(".", "").replace(",", ".")
+        try:
+            return float(text)
+        except ValueError:
+            return None
+
+    def format_currency(value: Optional[float]) -> str:
+        if value is None:
+            return ""
+        formatted = f"{value:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+        return f"R$ {formatted}"
+
+    def format_number(value: Optional[float], suffix: str = "") -> str:
+        if value is None:
+            return ""
+        formatted = (
+            f"{value:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+        )
+        return f"{formatted}{suffix}"
+
+    def split_mes_ano(label: str) -> (str, str):
+        if not label:
+            return ("—", "")
+        label = label.strip()
+        match = re.match(r"([A-Za-zÀ-ÿ]+)[^\d]*(\d{2,4})", label)
+        if match:
+            mes = match.group(1).upper()
+            ano = match.group(2)
+            if len(ano) == 2:
+                ano = f"20{ano}"
+            return (mes, ano)
+        return (label, "")
+
+    consumo_atual_val = parse_decimal(pick("consumo kwh", ""))
+    energia_injetada_val = parse_decimal(pick("Energia Atv Injetada", ""))
+    preco_unitario_val = parse_decimal(pick("preco unit com tributos", ""))
+    valor_total_val = parse_decimal(pick("valor a pagar", ""))
+    economia_val = parse_decimal(pick("Economia", ""))
+    valor_pagar_val = parse_decimal(pick("valor a pagar", ""))
+    saldo_acumulado_val = parse_decimal(pick("saldo acumulado", ""))
+
+    historico_items = []
+    consumos_validos: List[float] = []
+    for raw_item in dados.get("historico de consumo", []):
+        if isinstance(raw_item, dict):
+            mes_label = raw_item.get("mes", "")
+            consumo_raw = raw_item.get("consumo", "")
+        else:
+            mes_label = getattr(raw_item, "mes", "")
+            consumo_raw = getattr(raw_item, "consumo", "")
+        mes, ano = split_mes_ano(mes_label)
+        consumo_val = parse_decimal(consumo_raw)
+        has_consumo = consumo_val is not None and consumo_val > 0
+        if has_consumo:
+            consumos_validos.append(consumo_val)
+        historico_items.append(
+            {
+                "rotulo": f"{mes}/{ano}" if ano else mes,
+                "consumo_display": format_number(consumo_val, " kWh")
+                if consumo_val is not None
+                else ("Sem dados" if consumo_raw in (None, "", "0") else consumo_raw),
+                "has_consumo": has_consumo,
+            }
+        )
+
+    historico_resumo = ""
+    if consumos_validos:
+        media = sum(consumos_validos) / len(consumos_validos)
+        historico_resumo = (
+            f"{len(consumos_validos)} meses com consumo registrado | "
+            f"Média: {format_number(media, ' kWh')}"
+        )
+
+    bandeira_val = dados.get("bandeira") or ""
+    bandeira_classe = ""
+    if isinstance(bandeira_val, str):
+        lower = bandeira_val.lower()
+        if "vermelha" in lower:
+            bandeira_classe = "bandeira-vermelha"
+        elif "amarela" in lower:
+            bandeira_classe = "bandeira-amarela"
+        elif lower.strip():
+            bandeira_classe = "bandeira-verde"
+
+    cliente = {
+        "nome": pick("nome do cliente"),
+        "codigo_uc": pick("codigo do cliente - uc"),
+        "cpf_cnpj": dados.get("documento do cliente", "—"),
+        "telefone": dados.get("telefone", ""),
+        "email": dados.get("email", ""),
+        "endereco": dados.get("endereco", None),
+    }
+
+    fatura = {
+        "numero_fatura": dados.get("numero da fatura", pick("codigo do cliente - uc")),
+        "data_vencimento": pick("data de vencimento"),
+        "data_emissao": pick("data de emissao"),
+        "valor_total_display": format_currency(valor_total_val) or pick("valor a pagar"),
+        "valor_total_num": valor_total_val or 0.0,
+        "codigo_barras": dados.get("codigo de barras", ""),
+        "saldo_acumulado_display": format_currency(saldo_acumulado_val)
+        if saldo_acumulado_val is not None
+        else pick("saldo acumulado"),
+    }
+
+    context = {
+        "logo_path": get_logo_data_uri(),
+        "qrcode_path": get_qrcode_data_uri(),
+        "mes_referencia": pick("mes de referencia"),
+        "data_atual": (data_atual or datetime.now().date()).strftime("%d/%m/%Y"),
+        "cliente": cliente,
+        "fatura": fatura,
+        "consumo_atual": format_number(consumo_atual_val, " kWh")
+        if consumo_atual_val is not None
+        else pick("consumo kwh"),
+        "energia_ativa_display": format_number(energia_injetada_val, " kWh")
+        if energia_injetada_val is not None
+        else pick("Energia Atv Injetada"),
+        "preco_unitario_display": format_number(preco_unitario_val)
+        if preco_unitario_val is not None
+        else pick("preco unit com tributos"),
+        "economia_display": format_currency(economia_val)
+        if economia_val is not None
+        else "",
+        "valor_pagar_display": format_currency(valor_pagar_val)
+        if valor_pagar_val is not None
+        else fatura["valor_total_display"],
+        "saldo_acumulado_display": fatura["saldo_acumulado_display"],
+        "bandeira": bandeira_val if isinstance(bandeira_val, str) else "",
+        "bandeira_classe": bandeira_classe,
+        "historico_consumo": historico_items,
+        "historico_resumo": historico_resumo,
+    }
+    return context
+
+def pdf_cache_key(context: Dict) -> str:
+    """Hash do contexto normalizado; logo e QR Code são constantes do processo."""
+    normalizado = {
+        chave: valor
+        for chave, valor in context.items()
+        if chave not in ("logo_path", "qrcode_path")
+    }
+    payload = json.dumps(normalizado, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _cache_get(key: str) -> Optional[bytes]:
+    with _pdf_cache_lock:
+        pdf_bytes = _pdf_cache.get(key)
+        if pdf_bytes is not None:
+            _pdf_cache.move_to_end(key)
+        return pdf_bytes
+
+
+def _cache_put(key: str, pdf_bytes: bytes) -> None:
+    with _pdf_cache_lock:
+        _pdf_cache[key] = pdf_bytes
+        _pdf_cache.move_to_end(key)
+        while len(_pdf_cache) > PDF_CACHE_SIZE:
+            _pdf_cache.popitem(last=False)
+
+
+def _write_pdf(html_content: str) -> bytes:
+    return HTML(string=html_content, base_url=str(TEMPLATES_DIR)).write_pdf(
+        stylesheets=[PDF_STYLESHEET], font_config=FONT_CONFIG
+    )
+
+
+def render_pdf(dados: Dict, data_atual: Optional[date] = None) -> bytes:
+    """Gera o PDF da fatura, reaproveitando renderizações de contexto idêntico.
+
+    ``data_atual`` é a data de geração impressa no documento (padrão: hoje) e
+    faz parte da chave do cache.
+    """
+    context = map_pdf_context(dados, data_atual)
+    key = pdf_cache_key(context)
+    pdf_bytes = _cache_get(key)
+    if pdf_bytes is None:
+        pdf_bytes = _write_pdf(PDF_TEMPLATE.render(**context))
+        _cache_put(key, pdf_bytes)
+    return pdf_bytes
+
+
+def render_pdfs_em_lote(
+    lista_dados: Sequence[Dict], data_atual: Optional[date] = None
+) -> List[bytes]:
+    """Gera vários PDFs com um único layout do WeasyPrint e separa as páginas.
+
+    Cada fatura é envolvida em um bloco com âncora própria e quebra de página;
+    depois do layout, as páginas são agrupadas pela âncora em que começam. O
+    ``<head>`` do template e a remoção das âncoras do lote mantêm os metadados
+    (título) iguais aos de ``render_pdf``, que compartilha o mesmo cache.
+    """
+    contexts = [map_pdf_context(dados, data_atual) for dados in lista_dados]
+    keys = [pdf_cache_key(context) for context in contexts]
+    resultados: List[Optional[bytes]] = [_cache_get(key) for key in keys]
+    pendentes = [index for index, pdf in enumerate(resultados) if pdf is None]
+    if not pendentes:
+        return resultados  # type: ignore[return-value]
+
+    blocos = []
+    cabecalho = '<meta charset="UTF-8" />'
+    for posicao, index in enumerate(pendentes):
+        html_fatura = PDF_TEMPLATE.render(**contexts[index])
+        if posicao == 0:
+            match = re.search(r"<head[^>]*>(.*)</head>", html_fatura, re.DOTALL)
+            cabecalho = match.group(1) if match else cabecalho
+        match = re.search(r"<body[^>]*>(.*)</body>", html_fatura, re.DOTALL)
+        corpo = match.group(1) if match else html_fatura
+        quebra = "" if posicao == 0 else ' style="break-before: page"'
+        blocos.append(f'<div id="fatura-lote-{index}"{quebra}>{corpo}</div>')
+    documento_html = (
+        f'<!DOCTYPE html><html lang="pt-BR"><head>{cabecalho}</head>'
+        f"<body>{''.join(blocos)}</body></html>"
+    )
+    documento = HTML(string=documento_html, base_url=str(TEMPLATES_DIR)).render(
+        stylesheets=[PDF_STYLESHEET], font_config=FONT_CONFIG
+    )
+
+    paginas_por_fatura: Dict[int, list] = {index: [] for index in pendentes}
+    atual = pendentes[0]
+    for pagina in documento.pages:
+        for anchor in list(pagina.anchors):
+            if anchor.startswith("fatura-lote-"):
+                atual = int(anchor.rsplit("-", 1)[1])
+                del pagina.anchors[anchor]
+                break
+        paginas_por_fatura[atual].append(pagina)
+
+    for index in pendentes:
+        pdf_bytes = documento.copy(paginas_por_fatura[index]).write_pdf()
+        _cache_put(keys[index], pdf_bytes)
+        resultados[index] = pdf_bytes
+    return resultados  # type: ignore[return-value]
+
+
+def render_preview_html(dados: Dict) -> str:
+    """Pré-visualização HTML instantânea com os mesmos valores formatados do PDF."""
+    return PREVIEW_TEMPLATE.render(**map_pdf_context(dados))
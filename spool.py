@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import mmap
+import os
+import re
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Iterator
+
+from decouple import config
+
+# ========================================
+# CONFIGURAÇÕES
+# ========================================
+SPOOL_ROOT = Path(
+    config("SPOOL_DIR", default=str(Path(tempfile.gettempdir()) / "boeira_spool"))
+)
+SPOOL_TTL_HORAS = config("SPOOL_TTL_HORAS", default=24.0, cast=float)
+CHUNK_SIZE = 1024 * 1024
+
+
+def _nome_seguro(nome: str) -> str:
+    return re.sub(r"[^\w.\- ]", "_", Path(nome).name) or "arquivo"
+
+
+class Spool:
+    """Diretório temporário de uma sessão: uploads, PDFs gerados e o .zip.
+
+    Os arquivos ficam em disco para que o consumo de memória dependa apenas dos
+    arquivos em processamento, e não do tamanho do lote.
+    """
+
+    def __init__(self, sessao: str) -> None:
+        self.root = SPOOL_ROOT / _nome_seguro(sessao)
+        self.uploads_dir = self.root / "uploads"
+        self.pdfs_dir = self.root / "pdfs"
+        self.uploads_dir.mkdir(parents=True, exist_ok=True)
+        self.pdfs_dir.mkdir(parents=True, exist_ok=True)
+
+    def salvar_upload(self, arquivo: IO[bytes], chave: str) -> Path:
+        """Copia o upload em blocos para ``uploads/<chave>/<nome>``, uma vez por chave."""
+        destino = self.uploads_dir / _nome_seguro(chave) / _nome_seguro(arquivo.name)
+        if destino.exists():
+            return destino
+        destino.parent.mkdir(parents=True, exist_ok=True)
+        parcial = destino.with_suffix(destino.suffix + ".part")
+        arquivo.seek(0)
+        with open(parcial, "wb") as saida:
+            shutil.copyfileobj(arquivo, saida, CHUNK_SIZE)
+        arquivo.seek(0)
+        parcial.replace(destino)
+        return destino
+
+    def tocar(self) -> None:
+        """Marca a sessão como ativa para a limpeza por ``SPOOL_TTL_HORAS``."""
+        self.pdfs_dir.mkdir(parents=True, exist_ok=True)
+        os.utime(self.root)
+
+    def caminho_pdf(self, nome: str) -> Path:
+        return self.pdfs_dir / f"{_nome_seguro(nome)}.pdf"
+
+    def caminho_zip(self) -> Path:
+        return self.root / "faturas_boeira.zip"
+
+    def limpar_saidas(self) -> None:
+        """Remove PDFs e .zip de um lote anterior."""
+        shutil.rmtree(self.pdfs_dir, ignore_errors=True)
+        self.pdfs_dir.mkdir(parents=True, exist_ok=True)
+        self.caminho_zip().unlink(missing_ok=True)
+
+    def remover(self) -> None:
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def _ultima_modificacao(pasta: Path) -> float:
+    """mtime mais recente da pasta ou de qualquer item dentro dela."""
+    recente = pasta.stat().st_mtime
+    for raiz, dirs, arquivos in os.walk(pasta):
+        for nome in dirs + arquivos:
+            try:
+                recente = max(recente, os.stat(os.path.join(raiz, nome)).st_mtime)
+            except OSError:
+                continue
+    return recente
+
+
+def limpar_spools_antigos() -> None:
+    """Apaga spools de sessões sem atividade há mais de ``SPOOL_TTL_HORAS``.
+
+    A idade considera o item mais recente dentro do spool, já que gravações em
+    subpastas não alteram o mtime da pasta da sessão.
+    """
+    if not SPOOL_ROOT.exists():
+        return
+    limite = time.time() - SPOOL_TTL_HORAS * 3600
+    for pasta in SPOOL_ROOT.iterdir():
+        try:
+            if pasta.is_dir() and _ultima_modificacao(pasta) < limite:
+                shutil.rmtree(pasta, ignore_errors=True)
+        except OSError:
+            continue
+
+
+@contextmanager
+def abrir_mmap(caminho: Path) -> Iterator[mmap.mmap]:
+    """Mapeia o arquivo em memória (somente leitura) sem carregá-lo por inteiro."""
+    with open(caminho, "rb") as arquivo:
+        with mmap.mmap(arquivo.fileno(), 0, access=mmap.ACCESS_READ) as mapa:
+            yield mapa